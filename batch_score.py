@@ -0,0 +1,170 @@
+"""
+Bulk scoring of a JSONL or CSV file through the fitted pipeline and a model.
+
+The input is read in chunks, chunks are scored on a process pool (each worker loads the
+artifacts once) and the results are written in input order, with at most a few chunks
+in flight per worker so memory stays bounded however large the file is.
+
+    python batch_score.py records.jsonl predictions.csv \\
+        --pipeline final_fully_fitted_pipeline.pkl --model final_logreg_model.joblib \\
+        --thresholds final_logreg_thresholds.csv --workers 8 --chunksize 50000
+
+--ensemble knn,lgb,logreg,ann scores with all the saved final models instead of --model
+(see score_server.EnsembleScorer), combined with --combine vote or mean.
+
+Only the scorer's input columns are scored, taken by name, so other columns such as an id
+or the label may stay in the file. Output has one row per input row: any --keep-columns,
+then probability and label (probability >= threshold). The format (.csv or .jsonl) follows
+the output file name.
+"""
+from __future__ import annotations
+import argparse
+import collections
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import Any, Deque, Iterable, List, Optional
+
+import pandas as pd
+
+from score_server import EnsembleScorer, Scorer
+
+_scorer: Optional[Scorer] = None  #one per process (workers and the parent), set by _init_worker
+
+
+def _init_worker(pipeline: str, model: str, thresholds: Optional[str], threshold: Optional[float], metric: str,
+                 ensemble: Optional[List[str]] = None, combine: str = 'vote', policy: Optional[str] = None) -> None:
+    global _scorer
+    if ensemble:
+        _scorer = EnsembleScorer.from_files(pipeline, ensemble, metric=metric, combine=combine)
+    else:
+        _scorer = Scorer.from_files(pipeline, model, thresholds, threshold, metric, policy)
+
+
+def _score_chunk(chunk: pd.DataFrame, keep_columns: List[str]) -> pd.DataFrame:
+    missing = [c for c in _scorer.feature_names if c not in chunk.columns]
+    if missing:
+        raise ValueError(f'batch_score input is missing the input columns {missing}')
+    out = chunk[keep_columns].reset_index(drop=True)
+    proba = _scorer.predict_proba(chunk[_scorer.feature_names])
+    out['probability'] = proba
+    out['label'] = _scorer.decide(proba)
+    return out
+
+
+def read_chunks(path: str, chunksize: int) -> Iterable[pd.DataFrame]:
+    """CSV via pd.read_csv; anything else as JSONL (one record per line, {"features": {...}} unwrapped)."""
+    if path.endswith('.csv'):
+        yield from pd.read_csv(path, chunksize=chunksize)
+        return
+    records: List[Any] = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            records.append(record.get('features', record))
+            if len(records) == chunksize:
+                yield pd.DataFrame.from_records(records)
+                records = []
+    if records:
+        yield pd.DataFrame.from_records(records)
+
+
+def _write(out: pd.DataFrame, path: str, first: bool) -> None:
+    if path.endswith('.jsonl'):
+        text = out.to_json(orient='records', lines=True)
+        with open(path, 'w' if first else 'a') as f:
+            f.write(text if text.endswith('\n') else text + '\n')
+    else:
+        out.to_csv(path, mode='w' if first else 'a', header=first, index=False)
+
+
+def batch_score(input_path: str, output_path: str, pipeline: str, model: str, thresholds: Optional[str] = None,
+                threshold: Optional[float] = None, metric: str = 'f1', workers: Optional[int] = None,
+                chunksize: int = 50_000, keep_columns: Optional[List[str]] = None, ensemble: Optional[List[str]] = None,
+                combine: str = 'vote', policy: Optional[str] = None) -> int:
+    """
+    Scores input_path into output_path and returns the number of rows written.
+
+    Parameters
+    ----------
+    input_path : str
+        JSONL file (one record per line) or CSV file.
+    output_path : str
+        .csv or .jsonl file to (over)write.
+    pipeline, model : str
+        Artifact paths, e.g. final_fully_fitted_pipeline.pkl and final_logreg_model.joblib.
+    thresholds : str, optional
+        final_*_thresholds.csv; the row with the best `metric` sets the threshold.
+    threshold : float, optional
+        Explicit threshold, overrides thresholds.
+    workers : int, optional
+        Process count, defaults to os.cpu_count().
+    chunksize : int, default=50_000
+        Rows per task.
+    keep_columns : List[str], optional
+        Input columns copied to the output (e.g. an id). Only the scorer's input columns
+        (its feature_names) are scored, whatever else the file holds.
+    ensemble : List[str], optional
+        Model names (e.g. ['knn', 'logreg']) to score with an EnsembleScorer instead of model.
+    combine : str, default='vote'
+        How the ensemble models are combined, see EnsembleScorer.
+    policy : str, optional
+        final_*_policy.json (library.decision_policy); its selected threshold overrides thresholds.
+    """
+    workers = workers or os.cpu_count() or 1
+    keep_columns = keep_columns or []
+    pending: Deque[Future] = collections.deque()
+    rows = 0
+
+    #build the scorer here first: a bad artifact raises its own error before any worker starts,
+    #rather than a BrokenProcessPool, and forked workers find the artifacts already loaded
+    initargs = (pipeline, model, thresholds, threshold, metric, ensemble, combine, policy)
+    _init_worker(*initargs)
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=initargs) as pool:
+        def drain(limit: int) -> None:
+            nonlocal rows
+            while len(pending) > limit:
+                out = pending.popleft().result()  #oldest first keeps the input order
+                _write(out, output_path, first=rows == 0)
+                rows += len(out)
+
+        for chunk in read_chunks(input_path, chunksize):
+            pending.append(pool.submit(_score_chunk, chunk, keep_columns))
+            drain(2 * workers)  #bounded read-ahead
+        drain(0)
+
+    if rows == 0:
+        open(output_path, 'w').close()
+    return rows
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input')
+    parser.add_argument('output')
+    parser.add_argument('--pipeline', default='final_fully_fitted_pipeline.pkl')
+    parser.add_argument('--model', default='final_logreg_model.joblib')
+    parser.add_argument('--thresholds', default=None)
+    parser.add_argument('--threshold', type=float, default=None)
+    parser.add_argument('--metric', default='f1')
+    parser.add_argument('--policy', default=None, help='final_*_policy.json, overrides --thresholds')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunksize', type=int, default=50_000)
+    parser.add_argument('--keep-columns', nargs='*', default=[])
+    parser.add_argument('--ensemble', default=None, help='comma-separated model names, e.g. knn,lgb,logreg,ann')
+    parser.add_argument('--combine', default='vote', choices=['vote', 'mean'])
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    rows = batch_score(args.input, args.output, args.pipeline, args.model, args.thresholds, args.threshold,
+                       args.metric, args.workers, args.chunksize, args.keep_columns,
+                       args.ensemble.split(',') if args.ensemble else None, args.combine, args.policy)
+    seconds = time.perf_counter() - start
+    print(f'Scored {rows} rows in {seconds:.1f}s ({rows / max(seconds, 1e-9):.0f} rows/s) -> {args.output}')
+
+
+if __name__ == '__main__':
+    main()
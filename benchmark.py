@@ -0,0 +1,475 @@
+"""
+Benchmarks for the library.py transformers, pipelines and search helpers.
+
+Every case runs on synthetic data of the requested sizes: the personality cases resample
+rows of personality_dataset.csv (with a little jitter on the numeric columns, missing
+values kept), the titanic and customer cases draw frames with the columns their
+pipelines expect. Each phase (fit, transform, ...) is timed --repeat times and the
+fastest run is kept; peak memory comes from one extra run under tracemalloc.
+
+    python benchmark.py --sizes 1000,10000,100000 --out results.json
+    python benchmark.py --save-baseline                 # writes benchmark_baseline.json
+    python benchmark.py --compare                       # exit code 1 on regressions
+    python benchmark.py --cases mapping,personality_pipeline --sizes 10000000
+
+Cases whose cost grows faster than linearly (KNN imputation, find_random_state,
+halving_search) have a row cap and are skipped above it. A baseline is only
+meaningful on the machine it was recorded on.
+"""
+from __future__ import annotations
+import argparse
+import functools
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.base import clone
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+
+import library
+
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+PERSONALITY_NUMERIC = ['Time_spent_Alone', 'Social_event_attendance', 'Going_outside', 'Friends_circle_size', 'Post_frequency']
+
+
+############ Synthetic data. ###########
+@functools.lru_cache(maxsize=None)
+def _personality_base(path: str) -> pd.DataFrame:
+    return pd.read_csv(path)
+
+
+def make_personality(n_rows: int, seed: int = 0, path: str = 'personality_dataset.csv') -> pd.DataFrame:
+    """Rows resampled from personality_dataset.csv; numeric columns get N(0, 0.5) jitter, NaNs stay NaN."""
+    base = _personality_base(path)
+    rng = np.random.default_rng(seed)
+    df = base.iloc[rng.integers(0, len(base), n_rows)].reset_index(drop=True)
+    for c in PERSONALITY_NUMERIC:
+        df[c] = (df[c] + rng.normal(0, 0.5, n_rows)).clip(lower=0).round(1)
+    return df
+
+
+def _with_missing(rng: np.random.Generator, values: np.ndarray, rate: float) -> np.ndarray:
+    values = values.astype(np.float64)
+    values[rng.random(len(values)) < rate] = np.nan
+    return values
+
+
+def make_titanic(n_rows: int, seed: int = 0) -> pd.DataFrame:
+    """Columns of titanic_transformer's input plus Survived."""
+    rng = np.random.default_rng(seed)
+    gender = rng.choice(['Male', 'Female'], n_rows, p=[.65, .35])
+    survived = (rng.random(n_rows) < np.where(gender == 'Female', .7, .2)).astype(int)
+    return pd.DataFrame({
+        'Gender': gender,
+        'Class': rng.choice(['Crew', 'C3', 'C2', 'C1'], n_rows, p=[.4, .32, .13, .15]),
+        'Joined': rng.choice(['Southampton', 'Cherbourg', 'Queenstown', 'Belfast'], n_rows, p=[.7, .12, .1, .08]),
+        'Age': _with_missing(rng, rng.normal(30, 14, n_rows).clip(0.4, 80).round(), .05),
+        'Fare': _with_missing(rng, rng.lognormal(3, 1, n_rows).round(2), .05),
+        'Survived': survived,
+    })
+
+
+def make_customer(n_rows: int, seed: int = 0) -> pd.DataFrame:
+    """Columns of customer_transformer's input plus Rating."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'OS': rng.choice(['Android', 'iOS'], n_rows),
+        'ISP': rng.choice(['Verizon', 'AT&T', 'Sprint', 'T-Mobile', 'Other'], n_rows),
+        'Experience Level': rng.choice(['low', 'medium', 'high'], n_rows),
+        'Gender': rng.choice(['Male', 'Female'], n_rows),
+        'Age': _with_missing(rng, rng.normal(35, 12, n_rows).clip(13, 90).round(), .05),
+        'Time Spent': _with_missing(rng, rng.gamma(2, 200, n_rows).round(), .05),
+        'Rating': rng.integers(0, 2, n_rows),
+    })
+
+
+def _personality_xy(n_rows: int, seed: int) -> Tuple[pd.DataFrame, np.ndarray]:
+    df = make_personality(n_rows, seed)
+    return df.drop(columns='Personality'), (df['Personality'] == 'Introvert').astype(int).to_numpy()
+
+
+def _quiet(pipeline: Any) -> Any:
+    return clone(pipeline).set_params(verbose=False)
+
+
+############ Cases. ###########
+#name -> (setup, max_rows). setup(n_rows, seed) does the untimed preparation and returns {phase: callable}.
+CASES: Dict[str, Tuple[Callable[[int, int], Dict[str, Callable[[], Any]]], Optional[int]]] = {}
+
+
+def case(name: str, max_rows: Optional[int] = None) -> Callable:
+    def register(setup: Callable[[int, int], Dict[str, Callable[[], Any]]]) -> Callable:
+        CASES[name] = (setup, max_rows)
+        return setup
+    return register
+
+
+def _transformer_phases(transformer: Any, X: pd.DataFrame, y: Optional[np.ndarray] = None) -> Dict[str, Callable[[], Any]]:
+    fitted = clone(transformer).fit(X, y)
+    return {'fit': lambda: clone(transformer).fit(X, y), 'transform': lambda: fitted.transform(X)}
+
+
+@case('mapping')
+def _mapping(n_rows: int, seed: int):
+    X, _ = _personality_xy(n_rows, seed)
+    return _transformer_phases(library.CustomMappingTransformer('Stage_fear', {'No': 0, 'Yes': 1}), X)
+
+
+@case('ohe')
+def _ohe(n_rows: int, seed: int):
+    X = make_titanic(n_rows, seed).drop(columns='Survived')
+    return _transformer_phases(library.CustomOHETransformer('Joined'), X)
+
+
+@case('drop_columns')
+def _drop_columns(n_rows: int, seed: int):
+    X, _ = _personality_xy(n_rows, seed)
+    return _transformer_phases(library.CustomDropColumnsTransformer(['Post_frequency', 'Going_outside'], 'drop'), X)
+
+
+@case('sigma3')
+def _sigma3(n_rows: int, seed: int):
+    X, _ = _personality_xy(n_rows, seed)
+    return _transformer_phases(library.CustomSigma3Transformer('Time_spent_Alone'), X)
+
+
+@case('tukey')
+def _tukey(n_rows: int, seed: int):
+    X, _ = _personality_xy(n_rows, seed)
+    return _transformer_phases(library.CustomTukeyTransformer('Time_spent_Alone', 'outer'), X)
+
+
+@case('robust')
+def _robust(n_rows: int, seed: int):
+    X, _ = _personality_xy(n_rows, seed)
+    return _transformer_phases(library.CustomRobustTransformer('Time_spent_Alone'), X)
+
+
+@case('knn', max_rows=20_000)
+def _knn(n_rows: int, seed: int):
+    X, _ = _personality_xy(n_rows, seed)
+    return _transformer_phases(library.CustomKNNTransformer(n_neighbors=5), X[PERSONALITY_NUMERIC])
+
+
+@case('knn_kd_tree', max_rows=200_000)
+def _knn_kd_tree(n_rows: int, seed: int):
+    X, _ = _personality_xy(n_rows, seed)
+    return _transformer_phases(library.CustomKNNTransformer(n_neighbors=5, index='kd_tree'), X[PERSONALITY_NUMERIC])
+
+
+@case('target')
+def _target(n_rows: int, seed: int):
+    df = make_titanic(n_rows, seed)
+    return _transformer_phases(library.CustomTargetTransformer(col='Joined', smoothing=10), df.drop(columns='Survived'), df['Survived'].to_numpy())
+
+
+@case('target_oof')
+def _target_oof(n_rows: int, seed: int):
+    df = make_customer(n_rows, seed)
+    encoder = library.CustomTargetTransformer(col='ISP', cv=5)
+    X, y = df.drop(columns='Rating'), df['Rating'].to_numpy()
+    return {'fit_transform': lambda: clone(encoder).fit_transform(X, y)}
+
+
+@case('multi_target')
+def _multi_target(n_rows: int, seed: int):
+    df = make_customer(n_rows, seed)
+    return _transformer_phases(library.CustomMultiTargetTransformer(['OS', 'ISP', 'Experience Level', 'Gender']),
+                               df.drop(columns='Rating'), df['Rating'].to_numpy())
+
+
+def _stream_fit_phase(transformer: Any, df: pd.DataFrame, label: str) -> Callable[[], Any]:
+    #stream_fit has to fit what Pipeline.fit fits (out-of-fold target encodings included); checked once, untimed
+    X = df.drop(columns=label)
+    chunksize = max(1, len(df) // 4)
+    expected = clone(transformer).fit(X, df[label].to_numpy()).transform(X)
+    streamed = library.stream_fit(clone(transformer), df, label_column=label, chunksize=chunksize).transform(X)
+    assert np.allclose(expected.to_numpy(dtype=np.float64), streamed.to_numpy(dtype=np.float64), equal_nan=True), \
+        'stream_fit and Pipeline.fit disagree'
+    return lambda: library.stream_fit(clone(transformer), df, label_column=label, chunksize=chunksize)
+
+
+@case('titanic_pipeline', max_rows=20_000)
+def _titanic_pipeline(n_rows: int, seed: int):
+    df = make_titanic(n_rows, seed)
+    phases = _transformer_phases(_quiet(library.titanic_transformer), df.drop(columns='Survived'), df['Survived'].to_numpy())
+    return dict(phases, stream_fit=_stream_fit_phase(_quiet(library.titanic_transformer), df, 'Survived'))
+
+
+@case('customer_pipeline', max_rows=20_000)
+def _customer_pipeline(n_rows: int, seed: int):
+    df = make_customer(n_rows, seed)
+    phases = _transformer_phases(_quiet(library.customer_transformer), df.drop(columns='Rating'), df['Rating'].to_numpy())
+    return dict(phases, stream_fit=_stream_fit_phase(_quiet(library.customer_transformer), df, 'Rating'))
+
+
+@case('personality_pipeline', max_rows=20_000)
+def _personality_pipeline(n_rows: int, seed: int):
+    X, y = _personality_xy(n_rows, seed)
+    return _transformer_phases(_quiet(library.personality_transformer), X, y)
+
+
+@case('personality_pipeline_fused', max_rows=20_000)
+def _personality_pipeline_fused(n_rows: int, seed: int):
+    X, y = _personality_xy(n_rows, seed)
+    return _transformer_phases(library.fuse_pipeline(_quiet(library.personality_transformer)), X, y)
+
+
+@case('personality_pipeline_compact', max_rows=20_000)
+def _personality_pipeline_compact(n_rows: int, seed: int):
+    X, y = _personality_xy(n_rows, seed)
+    return _transformer_phases(library.set_dtype_policy(_quiet(library.personality_transformer)), X, y)
+
+
+@case('threshold_results')
+def _threshold_results(n_rows: int, seed: int):
+    rng = np.random.default_rng(seed)
+    actuals = rng.integers(0, 2, n_rows)
+    predicted = np.clip(actuals * .3 + rng.random(n_rows) * .7, 0, 1)
+    thresholds = np.round(np.arange(0.0, 1.01, .05), 2)
+    policy = library.decision_policy(actuals, predicted, precision_floor=.6, recall_floor=.9)
+    return {
+        'sweep': lambda: library.threshold_results(thresholds, actuals, predicted, styled=False),
+        'policy': lambda: library.decision_policy(actuals, predicted, precision_floor=.6, recall_floor=.9),
+        'repick': lambda: policy.repick('recall_floor', recall_floor=.8),
+        'decide': lambda: policy.decide(predicted),
+    }
+
+
+@case('find_random_state', max_rows=5_000)
+def _find_random_state(n_rows: int, seed: int):
+    X, y = _personality_xy(n_rows, seed)
+    transformer = _quiet(library.personality_transformer)
+    return {'search': lambda: library.find_random_state(X, y, transformer, n=20),
+            'search_graph': lambda: library.find_random_state(X, y, transformer, n=20, reuse_graph=True)}
+
+
+@case('halving_search', max_rows=50_000)
+def _halving_search(n_rows: int, seed: int):
+    X, y = _personality_xy(n_rows, seed)
+    Xt = _quiet(library.personality_transformer).fit_transform(X, y).to_numpy()
+    grid = {'C': [0.01, 0.1, 1.0, 10.0], 'penalty': ['l2'], 'solver': ['lbfgs']}
+    return {'search': lambda: library.halving_search(LogisticRegression(max_iter=1000), grid, Xt, y),
+            'search_resumable': lambda: _fresh_checkpoint_search(LogisticRegression(max_iter=1000), grid, Xt, y)}
+
+
+def _fresh_checkpoint_search(model: Any, grid: Dict[str, List[Any]], X: Any, y: np.ndarray) -> Any:
+    #a new checkpoint every run, so nothing is resumed and the fits are timed
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        return library.halving_search(model, grid, X, y, checkpoint=os.path.join(tmp, 'search.jsonl'))
+
+
+@case('halving_pipeline', max_rows=20_000)
+def _halving_pipeline(n_rows: int, seed: int):
+    X, y = _personality_xy(n_rows, seed)
+    model = Pipeline([('prep', _quiet(library.personality_transformer)), ('model', LogisticRegression(max_iter=1000))])
+    grid = {'model__C': [0.01, 0.1, 1.0, 10.0]}
+    refined = {'model__C': [0.03, 0.3, 3.0, 30.0]}
+    warm = library.FitCache()
+    library.halving_search(model, grid, X, y, fit_cache=warm)  #a first search fills the cache, untimed
+    return {'search': lambda: library.halving_search(model, grid, X, y),
+            'search_cached': lambda: library.halving_search(model, grid, X, y, fit_cache=library.FitCache()),
+            'search_warm_cache': lambda: library.halving_search(model, refined, X, y, fit_cache=warm)}
+
+
+@case('lime_explain', max_rows=500)
+def _lime_explain(n_rows: int, seed: int):
+    from explain import BatchExplainer
+
+    X, y = _personality_xy(n_rows, seed)
+    Xt = _quiet(library.personality_transformer).fit_transform(X, y)
+    model = LogisticRegression(max_iter=1000).fit(np.asarray(Xt), y)
+    predict = lambda Z: model.predict_proba(Z)[:, 1]
+    uncached = BatchExplainer(predict, Xt, num_samples=1000, n_jobs=1, cache_size=0, cache_key='exact')
+    rows = np.asarray(Xt)
+    return {'per_row': lambda: [uncached.explain(rows[[i]]) for i in range(len(rows))],  #one predict call per row, as lime
+            'batched': lambda: uncached.explain(rows),
+            'batched_cell_cache': lambda: BatchExplainer(predict, Xt, num_samples=1000, n_jobs=1).explain(rows)}
+
+
+############ Runner. ###########
+def _time(fn: Callable[[], Any], repeat: int) -> List[float]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _peak_bytes(fn: Callable[[], Any]) -> int:
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] - base
+    finally:
+        if started:
+            tracemalloc.stop()
+
+
+def run_benchmarks(names: Optional[List[str]] = None, sizes: Tuple[int, ...] = (1_000, 10_000, 100_000),
+                   repeat: int = 3, seed: int = 0, memory: bool = True,
+                   log: Optional[Callable[[str], None]] = print) -> List[Dict[str, Any]]:
+    """
+    Runs the registered cases at every size.
+
+    Parameters
+    ----------
+    names : List[str], optional
+        Cases to run, default all of CASES.
+    sizes : Tuple[int, ...]
+        Row counts. Sizes above a case's row cap are skipped for that case.
+    repeat : int, default=3
+        Timed runs per phase; the fastest and the median are kept.
+    seed : int, default=0
+        Seed for the synthetic data.
+    memory : bool, default=True
+        Also measure peak allocations (one extra, untimed run per phase).
+    log : Callable, optional
+        Progress output, one line per phase.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        One dict per (case, phase, rows): seconds (fastest), median_seconds, rows_per_sec and peak_bytes.
+    """
+    names = list(CASES) if names is None else names
+    unknown = [n for n in names if n not in CASES]
+    assert not unknown, f'run_benchmarks unknown cases {unknown}; known are {list(CASES)}'
+
+    results = []
+    for name in names:
+        setup, max_rows = CASES[name]
+        for n_rows in sizes:
+            if max_rows is not None and n_rows > max_rows:
+                if log:
+                    log(f'{name:<28} {n_rows:>10,} rows  skipped (cap {max_rows:,})')
+                continue
+            for phase, fn in setup(n_rows, seed).items():
+                fn()  #warm-up: imports, caches, first-touch allocation
+                times = _time(fn, repeat)
+                result = {
+                    'case': name,
+                    'phase': phase,
+                    'rows': n_rows,
+                    'repeat': repeat,
+                    'seconds': min(times),
+                    'median_seconds': statistics.median(times),
+                    'rows_per_sec': n_rows / min(times) if min(times) > 0 else None,
+                    'peak_bytes': _peak_bytes(fn) if memory else None,
+                }
+                results.append(result)
+                if log:
+                    peak = f'{result["peak_bytes"] / 2**20:9.1f} MiB' if memory else ''
+                    log(f'{name:<28} {n_rows:>10,} rows  {phase:<10} {result["seconds"]:9.4f}s  '
+                        f'{result["rows_per_sec"] or 0:>14,.0f} rows/s {peak}')
+    return results
+
+
+def environment() -> Dict[str, Any]:
+    return {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'sklearn': sklearn.__version__,
+    }
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float = 0.25,
+            memory_tolerance: float = 0.25, min_seconds: float = 0.005) -> List[Dict[str, Any]]:
+    """
+    Matches results to baseline by (case, phase, rows) and flags regressions.
+
+    A phase regresses when it is more than `tolerance` slower than the baseline, or its peak
+    memory grew by more than `memory_tolerance`. Phases faster than min_seconds in both runs
+    are too noisy to judge and only reported.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        One dict per matched phase with the baseline and current numbers, their ratios and a 'regression' flag.
+    """
+    base = {(r['case'], r['phase'], r['rows']): r for r in baseline}
+    rows = []
+    for r in results:
+        b = base.get((r['case'], r['phase'], r['rows']))
+        if b is None:
+            continue
+        time_ratio = r['seconds'] / b['seconds'] if b['seconds'] > 0 else float('inf')
+        memory_ratio = None
+        if r.get('peak_bytes') is not None and b.get('peak_bytes'):
+            memory_ratio = r['peak_bytes'] / b['peak_bytes']
+        judged = max(r['seconds'], b['seconds']) >= min_seconds
+        rows.append({
+            'case': r['case'], 'phase': r['phase'], 'rows': r['rows'],
+            'baseline_seconds': b['seconds'], 'seconds': r['seconds'], 'time_ratio': time_ratio,
+            'baseline_peak_bytes': b.get('peak_bytes'), 'peak_bytes': r.get('peak_bytes'), 'memory_ratio': memory_ratio,
+            'regression': (judged and time_ratio > 1 + tolerance)
+                          or (memory_ratio is not None and memory_ratio > 1 + memory_tolerance),
+        })
+    return rows
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', default=None, help=f'comma separated, default all: {",".join(CASES)}')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='comma separated row counts (1000 to 10000000)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run')
+    parser.add_argument('--out', default=None, help='write results JSON here')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the baseline')
+    parser.add_argument('--compare', action='store_true', help='compare with the baseline; exit 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown, 0.25 = 25%%')
+    parser.add_argument('--memory-tolerance', type=float, default=0.25, help='allowed peak memory growth')
+    args = parser.parse_args(argv)
+
+    names = args.cases.split(',') if args.cases else None
+    sizes = tuple(int(s.replace('_', '')) for s in args.sizes.split(','))
+    results = run_benchmarks(names, sizes, args.repeat, args.seed, memory=not args.no_memory)
+    report = {'environment': environment(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=1)
+        print(f'Baseline written to {args.baseline}')
+    if not args.compare:
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['environment'] != report['environment']:
+        print(f'Warning: baseline was recorded on {baseline["environment"]}')
+    rows = compare(results, baseline['results'], args.tolerance, args.memory_tolerance)
+    for row in rows:
+        memory = f'{row["memory_ratio"]:6.2f}x mem' if row['memory_ratio'] is not None else ''
+        flag = '  REGRESSION' if row['regression'] else ''
+        print(f'{row["case"]:<28} {row["rows"]:>10,} rows  {row["phase"]:<10} '
+              f'{row["baseline_seconds"]:9.4f}s -> {row["seconds"]:9.4f}s  {row["time_ratio"]:6.2f}x time {memory}{flag}')
+    regressions = sum(row['regression'] for row in rows)
+    print(f'{len(rows)} phases compared, {regressions} regressions')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,344 @@
+"""
+Batched LIME explanations for the fitted pipeline and a model.
+
+BatchExplainer reproduces LIME's tabular explainer as configured for lime_explainer.pkl:
+quartile discretization of the transformed features, perturbations sampled per quartile,
+an exponential kernel on the distance to the explained row and a weighted ridge surrogate.
+Unlike lime, which runs the pipeline and the model once per explained row, it works on
+batches:
+
+- the pipeline transforms the batch once, and perturbations are generated in that space
+- the perturbations of many rows go to the model in one predict_proba call
+- all the per-row surrogates are fitted together as one stacked linear solve
+- explanations are cached (LRU) by the row's quartile cell. Rows in the same cell draw the
+  same perturbations and differ only in the first one (the row itself), so the cached
+  explanation of any of them stands for all; the model's prediction for each row is still
+  computed fresh
+- chunks of rows are explained in parallel on a thread pool
+
+Explain a file (one JSON explanation per input row):
+    python explain.py records.jsonl explanations.jsonl --train personality_dataset.csv \\
+        --label Personality --pipeline final_fully_fitted_pipeline.pkl --model final_logreg_model.joblib
+
+score_server.py serve --explain-train ... serves the same explanations on POST /explain and can
+attach them to a share of the /score replies (--explain-fraction).
+"""
+from __future__ import annotations
+import argparse
+import collections
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.special import ndtr, ndtri
+
+from score_server import EnsembleScorer, Scorer, records_frame
+
+
+class BatchExplainer:
+    """
+    LIME (tabular, quartile-discretized) explanations of a binary classifier, computed in batches.
+
+    Parameters
+    ----------
+    predict_fn : Callable[[np.ndarray], np.ndarray]
+        Positive-class probability for rows of transformed features (n_rows, n_features).
+    training_data : array-like
+        Transformed training rows; sets the quartiles and the per-quartile sampling statistics.
+    feature_names : List[str], optional
+        Names used in the explanations. Defaults to training_data's columns.
+    transform : Callable, optional
+        Turns raw rows (a DataFrame) into transformed features, e.g. the fitted pipeline's
+        transform. Without it, explain expects transformed features.
+    num_samples : int, default=5000
+        Perturbations per explained row (the first one is the row itself), as in lime.
+    num_features : int, default=10
+        Features kept in each explanation; when fewer than all, they are picked by lime's
+        'highest_weights' selection.
+    kernel_width : float, optional
+        Defaults to 0.75 * sqrt(n_features), as in lime.
+    cache_size : int, default=10_000
+        Explanations kept in the LRU cache; 0 disables it.
+    cache_key : {'cell', 'exact'}, default='cell'
+        'cell' shares an explanation between rows in the same quartile cell (near-identical
+        rows; the first one explained stands for the others, also within a batch when the
+        cache is disabled); 'exact' only between identical feature vectors.
+    n_jobs : int, default=4
+        Threads explaining chunks of rows in parallel.
+    max_rows_per_call : int, default=500_000
+        Perturbed rows per predict_fn call; bounds the memory of a chunk.
+    random_state : int, default=0
+        Seeds the perturbations of each cell, so results do not depend on batching.
+    input_columns : List[str], optional
+        Raw input columns for score(): records are put in this order and a record with
+        missing or extra keys is rejected (score_server.records_frame). from_scorer sets
+        them to the scorer's feature_names.
+    """
+
+    def __init__(self, predict_fn: Callable[[np.ndarray], np.ndarray], training_data: Any,
+                 feature_names: Optional[List[str]] = None, transform: Optional[Callable[[Any], Any]] = None,
+                 num_samples: int = 5000, num_features: int = 10, kernel_width: Optional[float] = None,
+                 cache_size: int = 10_000, cache_key: str = 'cell', n_jobs: int = 4,
+                 max_rows_per_call: int = 500_000, random_state: int = 0,
+                 input_columns: Optional[List[str]] = None) -> None:
+        assert cache_key in ('cell', 'exact'), f'{self.__class__.__name__} cache_key must be "cell" or "exact" but got {cache_key}'
+        assert num_samples >= 2, f'{self.__class__.__name__} num_samples must be at least 2 but got {num_samples}'
+        if feature_names is None:
+            feature_names = list(training_data.columns) if hasattr(training_data, 'columns') else [f'x{i}' for i in range(np.shape(training_data)[1])]
+        data = np.asarray(training_data, dtype=np.float64)
+        assert data.ndim == 2 and data.shape[1] == len(feature_names), f'{self.__class__.__name__} training_data must have one column per feature name.'
+
+        self.predict_fn = predict_fn
+        self.feature_names = list(feature_names)
+        self.transform = transform
+        self.num_samples = num_samples
+        self.num_features = min(num_features, len(self.feature_names))
+        self.kernel_width = np.sqrt(data.shape[1]) * .75 if kernel_width is None else kernel_width
+        self.cache_size = cache_size
+        self.cache_key = cache_key
+        self.n_jobs = n_jobs
+        self.max_rows_per_call = max_rows_per_call
+        self.random_state = random_state
+        self.input_columns = None if input_columns is None else list(input_columns)
+        self._fit_stats(data)
+
+        self._cache: collections.OrderedDict = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._pool = ThreadPoolExecutor(max_workers=n_jobs, thread_name_prefix='explain') if n_jobs > 1 else None
+
+    @classmethod
+    def from_scorer(cls, scorer: Scorer, training_frame: pd.DataFrame, **kwargs) -> 'BatchExplainer':
+        """
+        Explains a Scorer (or EnsembleScorer): perturbations are made after its pipeline and
+        scored with predict_transformed. training_frame holds raw rows; kwargs go to the constructor.
+        """
+        def transform(X: pd.DataFrame) -> Any:
+            return scorer.pipeline.transform(X[scorer.feature_names])
+
+        kwargs.setdefault('input_columns', scorer.feature_names)
+        Xt = transform(training_frame)
+        if not hasattr(Xt, 'columns'):
+            return cls(scorer.predict_transformed, Xt, transform=transform, **kwargs)
+        columns = list(Xt.columns)  #perturbations keep the pipeline's column names for models fitted on frames
+        return cls(lambda Z: scorer.predict_transformed(pd.DataFrame(Z, columns=columns)), Xt, transform=transform, **kwargs)
+
+    def _fit_stats(self, data: np.ndarray) -> None:
+        """Quartiles per feature and, per quartile, the frequency, mean, std, min and max (lime's QuartileDiscretizer)."""
+        self.quartiles = [np.unique(np.nanpercentile(col, [25, 50, 75])) for col in data.T]
+        self.names: List[List[str]] = []
+        n_features, width = data.shape[1], max(len(qts) for qts in self.quartiles) + 1
+        self.cum_freq = np.ones((n_features, width))
+        self.means, self.stds = np.zeros((n_features, width)), np.zeros((n_features, width))
+        self.mins, self.maxs = np.zeros((n_features, width)), np.zeros((n_features, width))
+        bins = self._bins(data)
+
+        for f, (name, col, qts) in enumerate(zip(self.feature_names, data.T, self.quartiles)):
+            self.names.append([f'{name} <= {qts[0]:.2f}'] + [f'{lo:.2f} < {name} <= {hi:.2f}' for lo, hi in zip(qts, qts[1:])]
+                              + [f'{name} > {qts[-1]:.2f}'])
+            counts = np.bincount(bins[:, f], minlength=len(qts) + 1).astype(np.float64)
+            self.cum_freq[f, :len(counts)] = np.cumsum(counts) / counts.sum()
+            edges = np.concatenate(([np.nanmin(col)], qts, [np.nanmax(col)]))
+            for b in range(len(qts) + 1):
+                values = col[bins[:, f] == b]
+                self.means[f, b] = values.mean() if len(values) else edges[b]
+                self.stds[f, b] = values.std() if len(values) else 0.0
+                self.mins[f, b], self.maxs[f, b] = edges[b], edges[b + 1]
+
+        safe = np.where(self.stds > 0, self.stds, 1.0)
+        self._cdf_low = ndtr((self.mins - self.means) / safe)
+        self._cdf_span = ndtr((self.maxs - self.means) / safe) - self._cdf_low
+
+        #lime scales the perturbations' bin-match indicators with the statistics of the discretized training data
+        self.bin_mean = bins.mean(axis=0)
+        self.bin_scale = np.where(bins.std(axis=0) > 0, bins.std(axis=0), 1.0)
+
+    def _bins(self, X: np.ndarray) -> np.ndarray:
+        return np.column_stack([np.searchsorted(qts, X[:, f]) for f, qts in enumerate(self.quartiles)])
+
+    def _key(self, row: np.ndarray, bins: np.ndarray) -> bytes:
+        return bins.tobytes() if self.cache_key == 'cell' else row.tobytes()
+
+    def _rng(self, key: bytes) -> np.random.Generator:
+        return np.random.default_rng([self.random_state, int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')])
+
+    def _perturb(self, rows: np.ndarray, bins: np.ndarray, keys: List[bytes]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        num_samples perturbations per row, the row itself first. Returns the perturbed features
+        (m, num_samples, n_features) and whether each perturbed feature stayed in the row's quartile.
+        """
+        m, n_features = rows.shape
+        u = np.stack([self._rng(key).random((2, self.num_samples, n_features)) for key in keys], axis=1)  #(2, m, S, F)
+        sampled = np.empty((m, self.num_samples, n_features), dtype=np.int64)
+        for f in range(n_features):
+            sampled[..., f] = np.minimum(np.searchsorted(self.cum_freq[f], u[0][..., f], side='right'), len(self.quartiles[f]))
+        cell = sampled + np.arange(n_features) * self.means.shape[1]  #flat (feature, quartile) index
+
+        #truncated normal within the quartile by inverse CDF, vectorized over every row and sample
+        p = np.clip(self._cdf_low.take(cell) + u[1] * self._cdf_span.take(cell), 1e-12, 1 - 1e-12)
+        values = self.means.take(cell) + self.stds.take(cell) * ndtri(p)
+        values = np.clip(values, self.mins.take(cell), self.maxs.take(cell))
+
+        values[:, 0] = rows
+        same = sampled == bins[:, None, :]
+        same[:, 0] = True
+        return values, same
+
+    def _surrogates(self, same: np.ndarray, proba: np.ndarray) -> Dict[str, np.ndarray]:
+        """Kernel-weighted ridge fits of proba on the scaled bin-match indicators, all rows at once."""
+        Z = (same - self.bin_mean) / self.bin_scale
+        d = np.sqrt(((Z - Z[:, :1]) ** 2).sum(axis=2))
+        w = np.sqrt(np.exp(-d ** 2 / self.kernel_width ** 2))
+
+        selected = np.broadcast_to(np.arange(Z.shape[2]), (Z.shape[0], Z.shape[2]))
+        if self.num_features < Z.shape[2]:  #lime's 'highest_weights': rank by coef * value on a lightly regularised fit
+            coef, _ = _weighted_ridge(Z, proba, w, alpha=.01)
+            order = np.argsort(-np.abs(coef * Z[:, 0]), axis=1, kind='stable')
+            selected = np.sort(order[:, :self.num_features], axis=1)
+        Zs = np.take_along_axis(Z, selected[:, None, :], axis=2)
+        coef, intercept = _weighted_ridge(Zs, proba, w, alpha=1.0)
+
+        fitted = intercept[:, None] + np.einsum('msk,mk->ms', Zs, coef)
+        wm = (w * proba).sum(axis=1) / w.sum(axis=1)
+        total = (w * (proba - wm[:, None]) ** 2).sum(axis=1)
+        residual = (w * (proba - fitted) ** 2).sum(axis=1)
+        score = np.where(total > 0, 1 - residual / np.where(total > 0, total, 1.0), 1.0)
+        return {'selected': selected, 'coef': coef, 'intercept': intercept, 'local_pred': fitted[:, 0], 'score': score}
+
+    def _explain_chunk(self, rows: np.ndarray, bins: np.ndarray, keys: List[bytes]) -> List[Dict[str, Any]]:
+        values, same = self._perturb(rows, bins, keys)
+        m, S, F = values.shape
+        proba = np.asarray(self.predict_fn(values.reshape(m * S, F)), dtype=np.float64).reshape(m, S)
+        fit = self._surrogates(same, proba)
+
+        results = []
+        for i in range(m):
+            weights = [(int(f), float(c)) for f, c in zip(fit['selected'][i], fit['coef'][i])]
+            weights.sort(key=lambda fw: -abs(fw[1]))
+            results.append({
+                'intercept': float(fit['intercept'][i]),
+                'local_pred': float(fit['local_pred'][i]),
+                'score': float(fit['score'][i]),
+                'weights': [[self.names[f][bins[i, f]], c] for f, c in weights],
+            })
+        return results
+
+    def explain(self, X: Any) -> List[Dict[str, Any]]:
+        """
+        One explanation per row of X (raw rows when transform is set): the model's probability,
+        lime's intercept, local_pred and score, and [feature condition, weight] pairs by |weight|.
+        """
+        Xt = self.transform(X) if self.transform is not None else X
+        rows = np.asarray(Xt, dtype=np.float64)
+        if rows.ndim == 1:
+            rows = rows[None, :]
+        bins = self._bins(rows)
+        keys = [self._key(row, b) for row, b in zip(rows, bins)]
+
+        found: Dict[bytes, Dict[str, Any]] = {}
+        with self._lock:
+            for key in keys:
+                if key in self._cache and key not in found:
+                    self._cache.move_to_end(key)
+                    found[key] = self._cache[key]
+        todo = list(dict.fromkeys(k for k in keys if k not in found))  #each missing cell once, in order
+        first: Dict[bytes, int] = {}
+        for i, key in enumerate(keys):
+            first.setdefault(key, i)
+        with self._lock:
+            self.hits += len(keys) - len(todo)
+            self.misses += len(todo)
+
+        step = max(1, self.max_rows_per_call // self.num_samples)
+        if self.n_jobs > 1:
+            step = max(1, min(step, -(-len(todo) // self.n_jobs)))
+        chunks = [todo[i:i + step] for i in range(0, len(todo), step)]
+        run = lambda chunk: self._explain_chunk(rows[[first[k] for k in chunk]], bins[[first[k] for k in chunk]], chunk)
+        outputs = list(self._pool.map(run, chunks)) if self._pool is not None and len(chunks) > 1 else [run(c) for c in chunks]
+        for chunk, output in zip(chunks, outputs):
+            found.update(zip(chunk, output))
+
+        if todo and self.cache_size > 0:
+            with self._lock:
+                for key in todo:
+                    self._cache[key] = found[key]
+                    self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        proba = np.asarray(self.predict_fn(rows), dtype=np.float64)  #the rows' own predictions are never cached
+        return [dict(found[key], prediction=float(p)) for key, p in zip(keys, proba)]
+
+    def score(self, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Explanations for a list of raw records, so the explainer can sit behind a score_server.MicroBatcher."""
+        if self.input_columns is None:
+            return self.explain(pd.DataFrame.from_records(records))
+        return self.explain(records_frame(records, self.input_columns, self.__class__.__name__))
+
+    def stats(self) -> Dict[str, int]:
+        return {'entries': len(self._cache), 'hits': self.hits, 'misses': self.misses}
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+
+
+def _weighted_ridge(Z: np.ndarray, y: np.ndarray, w: np.ndarray, alpha: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    sklearn Ridge(alpha, fit_intercept=True) with sample_weight, for a stack of problems:
+    Z (m, S, k), y and w (m, S). Returns coef (m, k) and intercept (m,).
+    """
+    total = w.sum(axis=1, keepdims=True)
+    z_mean = (w[..., None] * Z).sum(axis=1) / total
+    y_mean = (w * y).sum(axis=1) / total[:, 0]
+    Zc, yc = Z - z_mean[:, None, :], y - y_mean[:, None]
+    ZcW = np.swapaxes(Zc * w[..., None], 1, 2)
+    A = ZcW @ Zc + alpha * np.eye(Z.shape[2])
+    coef = np.linalg.solve(A, ZcW @ yc[..., None])[..., 0]
+    return coef, y_mean - (z_mean * coef).sum(axis=1)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    from batch_score import read_chunks
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input')
+    parser.add_argument('output', help='.jsonl file, one explanation per input row')
+    parser.add_argument('--train', required=True, help='CSV of raw training rows for the quartile statistics')
+    parser.add_argument('--label', default=None, help='label column of --train (and of the input), dropped')
+    parser.add_argument('--pipeline', default='final_fully_fitted_pipeline.pkl')
+    parser.add_argument('--model', default='final_logreg_model.joblib')
+    parser.add_argument('--ensemble', default=None, help='comma-separated model names, e.g. knn,lgb,logreg,ann')
+    parser.add_argument('--num-samples', type=int, default=5000)
+    parser.add_argument('--num-features', type=int, default=10)
+    parser.add_argument('--jobs', type=int, default=4)
+    parser.add_argument('--chunksize', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    if args.ensemble:
+        scorer = EnsembleScorer.from_files(args.pipeline, args.ensemble.split(','))
+    else:
+        scorer = Scorer.from_files(args.pipeline, args.model)
+    drop = [args.label] if args.label else []
+    explainer = BatchExplainer.from_scorer(scorer, pd.read_csv(args.train).drop(columns=drop),
+                                           num_samples=args.num_samples, num_features=args.num_features, n_jobs=args.jobs)
+
+    start, rows = time.perf_counter(), 0
+    with open(args.output, 'w') as f:
+        for chunk in read_chunks(args.input, args.chunksize):
+            for explanation in explainer.explain(chunk.drop(columns=drop, errors='ignore')):
+                f.write(json.dumps(explanation) + '\n')
+            rows += len(chunk)
+    seconds = time.perf_counter() - start
+    print(f'Explained {rows} rows in {seconds:.1f}s ({rows / max(seconds, 1e-9):.0f} rows/s, cache {explainer.stats()}) -> {args.output}')
+    explainer.close()
+
+
+if __name__ == '__main__':
+    main()
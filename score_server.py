@@ -0,0 +1,578 @@
+"""
+Micro-batching HTTP scoring server for the fitted pipeline, plus a load generator.
+
+The server loads the fitted pipeline, the model and its threshold once. Concurrent
+requests are queued and scored together: a batch is cut when it reaches --max-batch
+rows or when its oldest request has waited --max-wait-ms, and each batch is a single
+transform + predict_proba call.
+
+Serve:
+    python score_server.py serve --pipeline final_fully_fitted_pipeline.pkl \\
+        --model final_logreg_model.joblib --thresholds final_logreg_thresholds.csv
+
+    --policy final_logreg_policy.json takes the threshold from a saved decision policy instead.
+
+    or an ensemble of the saved final_<name>_model.* files, each at its own best threshold:
+    python score_server.py serve --ensemble knn,lgb,logreg,ann --combine vote
+
+    POST /score  body: one record {"Time_spent_Alone": 4.0, ...} or a list of records
+                 reply: {"probability": 0.02, "label": 0} (or a list of them)
+                 every record needs exactly the pipeline's input columns as keys, in any order
+    POST /explain  (with --explain-train) LIME explanations of the records, see explain.py;
+                   --explain-fraction 0.05 also explains 5% of the /score records in the background:
+                   their replies come back at once with an "explanation_id"
+    GET /explanations/<explanation_id>  the explanation: 200 when ready, 202 while still running
+    GET /health
+
+Benchmark (replays a JSONL file with one record per line):
+    python score_server.py bench --file records.jsonl --concurrency 32 --requests 10000
+
+A JSONL file can be made from the dataset with
+    pd.read_csv('personality_dataset.csv').drop(columns='Personality').to_json('records.jsonl', orient='records', lines=True)
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+import library
+import serving
+
+
+class Scorer:
+    """
+    Fitted pipeline + model + threshold, scoring a list of records in one vectorized call.
+
+    Parameters
+    ----------
+    pipeline : Pipeline
+        Fitted preprocessing pipeline.
+    model : estimator
+        Fitted classifier with predict_proba.
+    threshold : float, default=0.5
+        Probability at or above which the label is 1.
+    feature_names : List[str], optional
+        Input columns, in the order the pipeline was fitted on. Defaults to
+        library.pipeline_input_columns(pipeline); needed when that can't tell them.
+        Every batch is put in this order, and a record with missing or extra keys
+        is rejected.
+    policy : serving.DecisionPolicy, optional
+        Decision policy saved with the model (library.decision_policy); its selected threshold
+        replaces threshold and repick can move it while serving.
+    """
+
+    def __init__(self, pipeline: Any, model: Any, threshold: float = 0.5, feature_names: Optional[List[str]] = None,
+                 policy: Optional[serving.DecisionPolicy] = None) -> None:
+        self.pipeline = pipeline
+        self.model = model
+        self.policy = policy
+        self.threshold = threshold if policy is None else policy.threshold
+        self.feature_names = _input_columns(pipeline, feature_names, self.__class__.__name__)
+
+    @classmethod
+    def from_files(cls, pipeline_path: str, model_path: str, thresholds_path: Optional[str] = None,
+                   threshold: Optional[float] = None, metric: str = 'f1', policy_path: Optional[str] = None) -> 'Scorer':
+        """
+        Loads the artifacts (memory-mapped, once per process, see serving.load_artifact); the threshold
+        is the given one, else the one selected by the policy_path DecisionPolicy, else the best
+        `metric` row of thresholds_path, else 0.5.
+        """
+        policy = serving.load_artifact(policy_path) if policy_path and threshold is None else None
+        if threshold is None and policy is None:
+            threshold = library.best_threshold(thresholds_path, metric) if thresholds_path else 0.5
+        return cls(serving.load_artifact(pipeline_path), serving.load_artifact(model_path), threshold, policy=policy)
+
+    def repick(self, objective: Optional[str] = None, precision_floor: Optional[float] = None,
+               recall_floor: Optional[float] = None) -> float:
+        """Moves the operating point with DecisionPolicy.repick (no rescoring) and returns the new threshold."""
+        assert self.policy is not None, f'{self.__class__.__name__}.repick needs a DecisionPolicy'
+        policy = self.policy.repick(objective, precision_floor, recall_floor)
+        self.policy, self.threshold = policy, policy.threshold
+        return self.threshold
+
+    def decide(self, proba: np.ndarray) -> np.ndarray:
+        """0/1 labels for a batch of probabilities, in one comparison."""
+        return (np.asarray(proba) >= self.threshold).astype(np.int8)
+
+    def frame(self, records: List[Dict[str, Any]]) -> pd.DataFrame:
+        """Records as a raw feature frame in feature_names order, see records_frame."""
+        return records_frame(records, self.feature_names, self.__class__.__name__)
+
+    def predict_proba(self, X: pd.DataFrame) -> np.ndarray:
+        """Positive-class probability for each row of a raw feature frame."""
+        return self.predict_transformed(self.pipeline.transform(X[self.feature_names]))
+
+    def predict_transformed(self, Xt: Any) -> np.ndarray:
+        """Positive-class probability for rows already through the pipeline (e.g. explain.BatchExplainer perturbations)."""
+        return _model_proba(self.model, Xt)
+
+    def score(self, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        proba = self.predict_proba(self.frame(records))
+        return [{'probability': p, 'label': label} for p, label in zip(proba.tolist(), self.decide(proba).tolist())]
+
+
+def _input_columns(pipeline: Any, feature_names: Optional[List[str]], owner: str) -> List[str]:
+    if feature_names is None:
+        feature_names = library.pipeline_input_columns(pipeline)
+    assert feature_names is not None, f'{owner} cannot tell the input columns of the pipeline, pass feature_names'
+    return list(feature_names)
+
+
+def records_frame(records: List[Dict[str, Any]], feature_names: List[str], owner: str = 'Scorer') -> pd.DataFrame:
+    """
+    JSON records as a frame with feature_names as its columns, in that order, whatever the key
+    order of each record. A record that is not an object, or has missing or extra keys, raises
+    ValueError (a null value is fine: the pipeline imputes it).
+    """
+    expected = set(feature_names)
+    for i, record in enumerate(records):
+        if not isinstance(record, dict):
+            raise ValueError(f'{owner} record {i} is not an object: {record!r}')
+        if record.keys() != expected:
+            raise ValueError(f'{owner} record {i} is missing {sorted(expected - record.keys())} '
+                             f'and has unexpected {sorted(record.keys() - expected)}')
+    return pd.DataFrame.from_records(records, columns=feature_names)
+
+
+def _model_proba(model: Any, Xt: Any) -> np.ndarray:
+    """Positive-class probability from a model, given the transformed features."""
+    if not hasattr(model, 'feature_names_in_'):
+        Xt = np.asarray(Xt)  #models trained on dataset_setup output saw plain arrays
+    if hasattr(model, 'predict_proba'):
+        proba = np.asarray(model.predict_proba(Xt))
+    else:  #keras: predict gives the sigmoid output
+        proba = np.asarray(model.predict(np.asarray(Xt, dtype=np.float32), verbose=0))
+    return proba[:, -1] if proba.ndim == 2 else proba.ravel()
+
+
+class EnsembleScorer:
+    """
+    Fitted pipeline + several models, each with its own threshold, scored as one.
+
+    The pipeline runs once per batch; the models then run concurrently on a thread pool.
+    sklearn (BLAS, KNN), LightGBM and Keras release the GIL while they compute, so a
+    batch takes about as long as the slowest model rather than the sum of all of them.
+
+    Parameters
+    ----------
+    pipeline : Pipeline
+        Fitted preprocessing pipeline shared by all models.
+    models : Dict[str, estimator]
+        Fitted classifiers by name (predict_proba, or predict for Keras).
+    thresholds : Dict[str, float]
+        Each model's own decision threshold.
+    combine : {'vote', 'mean'}, default='vote'
+        'vote': every model votes with its own threshold; the ensemble probability is the
+        weighted share of positive votes and the label is 1 when it reaches vote_threshold.
+        'mean': weighted mean of the probabilities, compared to the weighted mean of the
+        thresholds.
+    weights : Dict[str, float], optional
+        Weight per model, default 1 each.
+    vote_threshold : float, default=0.5
+        Share of (weighted) votes needed for label 1 with combine='vote'; ties count as positive.
+    details : bool, default=False
+        score() also reports every model's probability and label.
+    feature_names : List[str], optional
+        Input columns, as in Scorer: defaults to those of the shared pipeline.
+    """
+
+    def __init__(self, pipeline: Any, models: Dict[str, Any], thresholds: Dict[str, float], combine: str = 'vote',
+                 weights: Optional[Dict[str, float]] = None, vote_threshold: float = 0.5, details: bool = False,
+                 feature_names: Optional[List[str]] = None) -> None:
+        assert models, f'{self.__class__.__name__} needs at least one model'
+        assert combine in ('vote', 'mean'), f'{self.__class__.__name__} combine must be "vote" or "mean" but got {combine}'
+        missing = set(models) - set(thresholds)
+        assert not missing, f'{self.__class__.__name__} models without a threshold: {sorted(missing)}'
+        self.pipeline = pipeline
+        self.models = dict(models)
+        self.thresholds = {name: float(thresholds[name]) for name in self.models}
+        self.combine = combine
+        self.weights = {name: float((weights or {}).get(name, 1.0)) for name in self.models}
+        self.vote_threshold = vote_threshold
+        self.details = details
+        self.feature_names = _input_columns(pipeline, feature_names, self.__class__.__name__)
+        total = sum(self.weights.values())
+        #the ensemble probability is compared to this, which makes the class usable wherever a Scorer is
+        self.threshold = vote_threshold if combine == 'vote' else sum(self.weights[n] * self.thresholds[n] for n in self.models) / total
+        self._pool = ThreadPoolExecutor(max_workers=len(self.models), thread_name_prefix='ensemble') if len(self.models) > 1 else None
+
+    @classmethod
+    def from_files(cls, pipeline_path: str, names: Iterable[str] = ('knn', 'lgb', 'logreg', 'ann'), directory: str = '.',
+                   metric: str = 'f1', **kwargs) -> 'EnsembleScorer':
+        """
+        Loads final_<name>_model.joblib (or .keras) for each name through a serving.ArtifactRegistry.
+        Each threshold is the one selected by final_<name>_policy.json when it exists, else the best
+        `metric` row of final_<name>_thresholds.csv. kwargs go to the constructor.
+        """
+        registry = serving.ArtifactRegistry(directory)
+        models = {name: registry[f'final_{name}_model'] for name in names}
+        thresholds = {name: registry[f'final_{name}_policy'].threshold if f'final_{name}_policy' in registry
+                      else library.best_threshold(os.path.join(directory, f'final_{name}_thresholds.csv'), metric)
+                      for name in names}
+        return cls(serving.load_artifact(pipeline_path), models, thresholds, **kwargs)
+
+    def frame(self, records: List[Dict[str, Any]]) -> pd.DataFrame:
+        """Records as a raw feature frame in feature_names order, see records_frame."""
+        return records_frame(records, self.feature_names, self.__class__.__name__)
+
+    def predict_all(self, X: pd.DataFrame) -> Dict[str, np.ndarray]:
+        """Every model's positive-class probability for the rows of a raw feature frame."""
+        return self._predict_models(self.pipeline.transform(X[self.feature_names]))
+
+    def _predict_models(self, Xt: Any) -> Dict[str, np.ndarray]:
+        if self._pool is None:
+            return {name: _model_proba(model, Xt) for name, model in self.models.items()}
+        futures = {name: self._pool.submit(_model_proba, model, Xt) for name, model in self.models.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+    def _combine(self, probas: Dict[str, np.ndarray]) -> np.ndarray:
+        total = sum(self.weights.values())
+        if self.combine == 'vote':
+            return sum(self.weights[n] * (p >= self.thresholds[n]) for n, p in probas.items()) / total
+        return sum(self.weights[n] * p for n, p in probas.items()) / total
+
+    def predict_proba(self, X: pd.DataFrame) -> np.ndarray:
+        """Ensemble probability (share of votes, or mean probability) for each row."""
+        return self._combine(self.predict_all(X))
+
+    def predict_transformed(self, Xt: Any) -> np.ndarray:
+        """Ensemble probability for rows already through the pipeline, as Scorer.predict_transformed."""
+        return self._combine(self._predict_models(Xt))
+
+    def decide(self, proba: np.ndarray) -> np.ndarray:
+        """0/1 ensemble labels for a batch of ensemble probabilities, in one comparison."""
+        return (np.asarray(proba) >= self.threshold).astype(np.int8)
+
+    def score(self, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        probas = self.predict_all(self.frame(records))
+        ensemble = self._combine(probas)
+        results = [{'probability': p, 'label': label} for p, label in zip(ensemble.tolist(), self.decide(ensemble).tolist())]
+        if self.details:
+            per_model = {n: list(zip(p.tolist(), (p >= self.thresholds[n]).astype(np.int8).tolist())) for n, p in probas.items()}
+            for i, result in enumerate(results):
+                result['models'] = {n: {'probability': rows[i][0], 'label': rows[i][1]} for n, rows in per_model.items()}
+        return results
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+
+
+class MicroBatcher:
+    """
+    Collects single records from concurrent requests into batches for a Scorer.
+
+    Parameters
+    ----------
+    scorer : Scorer or EnsembleScorer
+        Does the actual scoring, in a worker thread so the event loop keeps accepting requests.
+    max_batch : int, default=256
+        Largest batch.
+    max_wait_ms : float, default=5.0
+        Latency budget: how long the first record of a batch may wait for company.
+    """
+
+    def __init__(self, scorer: Scorer, max_batch: int = 256, max_wait_ms: float = 5.0) -> None:
+        self.scorer = scorer
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.batches = 0
+        self.rows = 0
+
+    async def submit(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((record, future))
+        return await future
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            records = [record for record, _ in batch]
+            try:
+                results = await loop.run_in_executor(None, self.scorer.score, records)
+            except Exception as e:  #one bad batch must not kill the server
+                #nor fail its good records: score them one at a time so only the bad ones error
+                results = [e] if len(batch) == 1 else await loop.run_in_executor(None, self._score_each, records)
+            self.batches += 1
+            self.rows += len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _score_each(self, records: List[Dict[str, Any]]) -> List[Any]:
+        #the result of each record, or the exception it raised
+        results: List[Any] = []
+        for record in records:
+            try:
+                results.append(self.scorer.score([record])[0])
+            except Exception as e:
+                results.append(e)
+        return results
+
+
+class ScoringServer:
+    """
+    Minimal HTTP/1.1 (keep-alive) front end for a MicroBatcher, on asyncio streams.
+
+    With an explainer (a MicroBatcher around an explain.BatchExplainer), POST /explain returns
+    LIME explanations. A share explain_fraction of the /score records is also explained, in
+    the background so the score reply does not wait for it: the reply carries an
+    explanation_id to fetch from GET /explanations/<id>. The last max_explanations of them
+    are kept.
+    """
+
+    def __init__(self, batcher: MicroBatcher, explainer: Optional[MicroBatcher] = None, explain_fraction: float = 0.0,
+                 max_explanations: int = 10_000) -> None:
+        self.batcher = batcher
+        self.explainer = explainer
+        self.explain_fraction = explain_fraction if explainer is not None else 0.0
+        self.max_explanations = max_explanations
+        self._explanations: collections.OrderedDict = collections.OrderedDict()
+        self._explanation_ids = itertools.count()
+
+    async def _score(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        result = await self.batcher.submit(record)
+        if self.explain_fraction and random.random() < self.explain_fraction:
+            explanation_id = str(next(self._explanation_ids))
+            task = asyncio.ensure_future(self.explainer.submit(record))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())  #errors are reported on fetch
+            self._explanations[explanation_id] = task
+            while len(self._explanations) > self.max_explanations:
+                self._explanations.popitem(last=False)
+            result = dict(result, explanation_id=explanation_id)
+        return result
+
+    def _explanation(self, explanation_id: str) -> Tuple[str, Any]:
+        task = self._explanations.get(explanation_id)
+        if task is None:
+            return '404 Not Found', {'error': f'no explanation {explanation_id}'}
+        if not task.done():
+            return '202 Accepted', {'status': 'pending'}
+        if task.cancelled():
+            return '500 Internal Server Error', {'error': 'explanation cancelled'}
+        if task.exception() is not None:
+            return '500 Internal Server Error', {'error': repr(task.exception())}
+        return '200 OK', task.result()
+
+    async def _route(self, method: str, path: str, body: bytes) -> Tuple[str, Any]:
+        if method == 'GET' and path == '/health':
+            health = {'status': 'ok', 'batches': self.batcher.batches, 'rows': self.batcher.rows}
+            if self.explainer is not None:
+                health['explain'] = dict(self.explainer.scorer.stats(), pending=sum(not t.done() for t in self._explanations.values()))
+            return '200 OK', health
+        if method == 'GET' and path.startswith('/explanations/') and self.explainer is not None:
+            return self._explanation(path[len('/explanations/'):])
+        routes = {'/score': self._score}
+        if self.explainer is not None:
+            routes['/explain'] = self.explainer.submit
+        if method != 'POST' or path not in routes:
+            return '404 Not Found', {'error': f'no route for {method} {path}'}
+        try:
+            payload = json.loads(body)
+        except ValueError as e:
+            return '400 Bad Request', {'error': f'invalid JSON: {e}'}
+        try:
+            if isinstance(payload, list):
+                return '200 OK', list(await asyncio.gather(*(routes[path](r) for r in payload)))
+            return '200 OK', await routes[path](payload)
+        except (ValueError, TypeError) as e:  #records that don't fit the pipeline's input columns or types
+            return '400 Bad Request', {'error': repr(e)}
+        except Exception as e:
+            return '500 Internal Server Error', {'error': repr(e)}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, path, _ = line.decode('latin-1').split(' ', 2)
+                headers: Dict[str, str] = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = header.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, payload = await self._route(method, path, body)
+                data = json.dumps(payload).encode()
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n'
+                             f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode() + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8000) -> None:
+        workers = [asyncio.create_task(b.run()) for b in (self.batcher, self.explainer) if b is not None]
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f'Scoring on http://{host}:{port}/score (max_batch={self.batcher.max_batch}, '
+              f'max_wait_ms={self.batcher.max_wait * 1000:g}, threshold={self.batcher.scorer.threshold})')
+        if self.explainer is not None:
+            print(f'Explaining on http://{host}:{port}/explain (explain_fraction={self.explain_fraction:g})')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+
+############ Load generator. ###########
+def read_records(path: str) -> List[Dict[str, Any]]:
+    """One JSON record per line; a line like {"features": {...}} is unwrapped."""
+    records = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                records.append(record.get('features', record) if isinstance(record, dict) else record)
+    return records
+
+
+async def _post(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, host: str, path: str, body: bytes) -> int:
+    writer.write(f'POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n'
+                 f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        header = await reader.readline()
+        if header in (b'\r\n', b''):
+            break
+        key, _, value = header.decode('latin-1').partition(':')
+        if key.strip().lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+async def run_benchmark(records: List[Dict[str, Any]], host: str = '127.0.0.1', port: int = 8000, path: str = '/score',
+                        concurrency: int = 32, n_requests: Optional[int] = None) -> Dict[str, float]:
+    """
+    Replays records (cycling if n_requests is larger) over `concurrency` keep-alive connections.
+
+    Returns
+    -------
+    Dict[str, float]
+        requests, errors, seconds, throughput (req/s) and p50/p90/p99/max latency in ms.
+    """
+    n_requests = len(records) if n_requests is None else n_requests
+    bodies = [json.dumps(r).encode() for r in records]
+    counter = itertools.count()
+    latencies: List[float] = []
+    errors = 0
+
+    async def client() -> None:
+        nonlocal errors
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while (i := next(counter)) < n_requests:
+                start = time.perf_counter()
+                status = await _post(reader, writer, host, path, bodies[i % len(bodies)])
+                latencies.append(time.perf_counter() - start)
+                errors += status != 200
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    ms = np.array(latencies) * 1000
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'throughput': round(len(latencies) / seconds, 1),
+        'p50_ms': round(float(np.percentile(ms, 50)), 3),
+        'p90_ms': round(float(np.percentile(ms, 90)), 3),
+        'p99_ms': round(float(np.percentile(ms, 99)), 3),
+        'max_ms': round(float(ms.max()), 3),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    serve = sub.add_parser('serve', help='run the scoring server')
+    serve.add_argument('--pipeline', default='final_fully_fitted_pipeline.pkl')
+    serve.add_argument('--model', default='final_logreg_model.joblib')
+    serve.add_argument('--thresholds', default=None, help='final_*_thresholds.csv to take the threshold from')
+    serve.add_argument('--threshold', type=float, default=None, help='explicit threshold, overrides --thresholds')
+    serve.add_argument('--metric', default='f1', help='column of --thresholds to maximise')
+    serve.add_argument('--policy', default=None, help='final_*_policy.json (library.decision_policy); overrides --thresholds')
+    serve.add_argument('--ensemble', default=None, help='comma-separated model names, e.g. knn,lgb,logreg,ann; '
+                       'loads final_<name>_model.* and final_<name>_thresholds.csv instead of --model')
+    serve.add_argument('--combine', default='vote', choices=['vote', 'mean'], help='how --ensemble models are combined')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8000)
+    serve.add_argument('--max-batch', type=int, default=256)
+    serve.add_argument('--max-wait-ms', type=float, default=5.0)
+    serve.add_argument('--explain-train', default=None, help='CSV of raw training rows; enables POST /explain (explain.BatchExplainer)')
+    serve.add_argument('--explain-label', default=None, help='label column of --explain-train, dropped')
+    serve.add_argument('--explain-fraction', type=float, default=0.0, help='share of /score records explained in the background, '
+                       'fetched from GET /explanations/<explanation_id>')
+    serve.add_argument('--explain-samples', type=int, default=5000, help='LIME perturbations per explained row')
+
+    bench = sub.add_parser('bench', help='replay a JSONL file against a running server')
+    bench.add_argument('--file', required=True)
+    bench.add_argument('--host', default='127.0.0.1')
+    bench.add_argument('--port', type=int, default=8000)
+    bench.add_argument('--concurrency', type=int, default=32)
+    bench.add_argument('--requests', type=int, default=None, help='defaults to one pass over the file')
+
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        if args.ensemble:
+            scorer = EnsembleScorer.from_files(args.pipeline, args.ensemble.split(','), metric=args.metric, combine=args.combine)
+        else:
+            scorer = Scorer.from_files(args.pipeline, args.model, args.thresholds, args.threshold, args.metric, args.policy)
+        explainer = None
+        if args.explain_train:
+            from explain import BatchExplainer
+            train = pd.read_csv(args.explain_train).drop(columns=[args.explain_label] if args.explain_label else [])
+            explainer = MicroBatcher(BatchExplainer.from_scorer(scorer, train, num_samples=args.explain_samples),
+                                     args.max_batch, args.max_wait_ms)
+        server = ScoringServer(MicroBatcher(scorer, args.max_batch, args.max_wait_ms), explainer, args.explain_fraction)
+        asyncio.run(server.serve(args.host, args.port))
+    else:
+        result = asyncio.run(run_benchmark(read_records(args.file), args.host, args.port,
+                                           concurrency=args.concurrency, n_requests=args.requests))
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,516 @@
+"""
+NumPy-only scoring for pipelines exported with library.export_for_serving.
+
+Scoring workers should import this module rather than library.py. It only needs
+numpy, so a saved ServingPipeline loads without pandas or scikit-learn (unless the
+model itself could not be flattened, see ServingPipeline).
+
+ArtifactRegistry loads the other artifacts (fitted pipelines, models, explainers) by
+name on first use, memory-mapped and cached per process; the libraries an artifact
+needs are only imported when it is loaded.
+"""
+from __future__ import annotations
+import json
+import os
+import pickle
+import threading
+import numpy as np
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def _as_float(col: np.ndarray) -> np.ndarray:
+    """Float view of a column. Values that are not numbers become NaN."""
+    try:
+        return col.astype(np.float64)
+    except (TypeError, ValueError):
+        out = np.empty(len(col), dtype=np.float64)
+        for i, v in enumerate(col):
+            try:
+                out[i] = float(v)
+            except (TypeError, ValueError):
+                out[i] = np.nan
+        return out
+
+
+def _column(values: Any) -> Tuple[np.ndarray, bool]:
+    """One input column: float64 when every value is a number (or NaN), otherwise object."""
+    col = np.asarray(values)
+    if col.dtype.kind in 'fiub':
+        return col.astype(np.float64, copy=False), True
+    return (col if col.dtype == object else np.asarray(values, dtype=object)), False
+
+
+def _stack(cols: List[np.ndarray], done: List[bool]) -> np.ndarray:
+    """float64 matrix from columns, converting the ones not yet float."""
+    out = np.empty((len(cols[0]) if cols else 0, len(cols)), dtype=np.float64)
+    for j, (c, d) in enumerate(zip(cols, done)):
+        out[:, j] = c if d else _as_float(c)
+    return out
+
+
+def _lookup(col: np.ndarray, keys: np.ndarray, values: np.ndarray, unseen_nan: bool) -> np.ndarray:
+    """
+    Vectorized dict lookup: keys is sorted, values[i] belongs to keys[i].
+
+    Values without a key become NaN when unseen_nan is True (target encoding),
+    otherwise they are kept as numbers where possible (mapping, like Series.replace).
+    """
+    if keys.dtype.kind == 'U':
+        probe = col.astype(str)
+    else:
+        probe = _as_float(col)
+    idx = np.searchsorted(keys, probe)
+    idx[idx == len(keys)] = 0
+    hit = keys[idx] == probe if len(keys) else np.zeros(len(col), dtype=bool)
+    fallback = np.nan if unseen_nan else _as_float(col)
+    return np.where(hit, values[idx] if len(keys) else np.nan, fallback)
+
+
+def _nan_euclidean(A: np.ndarray, B: np.ndarray) -> np.ndarray:
+    """
+    Same distance as sklearn's nan_euclidean_distances: coordinates missing in either row are
+    skipped and the rest up-weighted. Operation order follows sklearn so ties break the same way.
+    """
+    missing_a = np.isnan(A)
+    missing_b = np.isnan(B)
+    A0 = np.where(missing_a, 0.0, A)
+    B0 = np.where(missing_b, 0.0, B)
+    dist = -2 * (A0 @ B0.T)
+    dist += np.einsum('ij,ij->i', A0, A0)[:, None]
+    dist += np.einsum('ij,ij->i', B0, B0)[None, :]
+    dist -= (A0 * A0) @ missing_b.T
+    dist -= missing_a @ (B0 * B0).T
+    np.clip(dist, 0, None, out=dist)
+    present = (1 - missing_a) @ (~missing_b).T
+    dist[present == 0] = np.nan
+    present = np.maximum(1, present)
+    dist /= present
+    dist *= A.shape[1]
+    return np.sqrt(dist)
+
+
+def _neighbour_weights(dist: np.ndarray, weights: str) -> np.ndarray:
+    if weights == 'distance':
+        with np.errstate(divide='ignore'):
+            w = 1.0 / dist
+        inf_mask = np.isinf(w)
+        inf_row = inf_mask.any(axis=1)
+        w[inf_row] = inf_mask[inf_row]  #exact matches take all the weight
+        w[np.isnan(w)] = 0.0
+        return w
+    w = np.ones_like(dist)
+    w[np.isnan(dist)] = 0.0
+    return w
+
+
+def _knn_impute(X: np.ndarray, fit_X: np.ndarray, n_neighbors: int, weights: str, col_means: np.ndarray) -> np.ndarray:
+    """KNNImputer.transform on plain arrays. Distances use the un-imputed rows, as in sklearn."""
+    mask = np.isnan(X)
+    rows = np.flatnonzero(mask.any(axis=1))
+    if not len(rows):
+        return X
+    X = X.copy()
+    dist = _nan_euclidean(X[rows], fit_X)
+    fit_present = ~np.isnan(fit_X)
+    for c in np.flatnonzero(mask[rows].any(axis=0)):
+        donors = np.flatnonzero(fit_present[:, c])
+        need = np.flatnonzero(mask[rows, c])
+        d = dist[need][:, donors]
+        all_nan = np.isnan(d).all(axis=1)
+        X[rows[need[all_nan]], c] = col_means[c]
+        need, d = need[~all_nan], d[~all_nan]
+        if not len(need):
+            continue
+        k = min(n_neighbors, len(donors))
+        nearest = np.argpartition(d, k - 1, axis=1)[:, :k]
+        nearest_dist = np.take_along_axis(d, nearest, axis=1)
+        w = _neighbour_weights(nearest_dist, weights)
+        X[rows[need], c] = (fit_X[donors[nearest], c] * w).sum(axis=1) / w.sum(axis=1)
+    return X
+
+
+class ServingPipeline:
+    """
+    A fitted pipeline (and optionally its model) flattened into NumPy arrays.
+
+    Built by library.export_for_serving. Each op is a tuple whose first item names it:
+
+    - ('map', j, keys, values, unseen_nan): sorted-key lookup on column j
+    - ('clip', j, low, high): Tukey / 3-sigma clipping
+    - ('scale', j, median, iqr): robust scaling
+    - ('select', idx): keep columns idx, in that order
+    - ('knn', fit_X, n_neighbors, weights, col_means): KNN imputation
+
+    The model is ('linear', coef, intercept), ('knn', fit_X, y, classes, n_neighbors, weights)
+    or ('object', estimator) for models that could not be flattened; the last one needs
+    the estimator's own library at load time. The flattened KNN model can pick a different
+    neighbour than sklearn when several training rows are exactly tied at the k-th distance.
+
+    Parameters
+    ----------
+    feature_names : List[str]
+        Input columns, in the order rows are expected.
+    ops : List[tuple]
+        Compiled steps, applied in order.
+    output_names : List[str]
+        Column names after the last op.
+    model : tuple, optional
+        Compiled model, see above.
+    threshold : float, default=0.5
+        Default decision threshold for predict.
+    policy : DecisionPolicy, optional
+        Decision policy saved with the model; when given, its selected threshold is the default.
+    """
+
+    def __init__(self, feature_names: List[str], ops: List[tuple], output_names: List[str],
+                 model: Optional[tuple] = None, threshold: float = 0.5, policy: Optional['DecisionPolicy'] = None) -> None:
+        self.feature_names = list(feature_names)
+        self.ops = ops
+        self.output_names = list(output_names)
+        self.model = model
+        self.policy = policy
+        self.threshold = threshold if policy is None else policy.threshold
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        state.setdefault('policy', None)  #saved before policy existed
+        self.__dict__.update(state)
+
+    def _columns(self, X: Any) -> Tuple[List[np.ndarray], List[bool]]:
+        """
+        Input columns in feature_names order, from a dict (one row), a list of dicts, a DataFrame
+        or a 2D array, and whether each one is already float64. Columns are built one at a time,
+        so numeric fields never go through a per-row object matrix.
+        """
+        if isinstance(X, dict):
+            X = [X]
+        if isinstance(X, list) and X and isinstance(X[0], dict):
+            cols = [_column([r.get(name, np.nan) for r in X]) for name in self.feature_names]
+        elif hasattr(X, 'columns'):
+            cols = [_column(X[name].to_numpy()) for name in self.feature_names]
+        else:
+            X = np.asarray(X)
+            assert X.ndim == 2 and X.shape[1] == len(self.feature_names), \
+                f'{self.__class__.__name__} expected {len(self.feature_names)} columns but got shape {X.shape}'
+            cols = [_column(X[:, j]) for j in range(X.shape[1])]
+        return [c for c, _ in cols], [d for _, d in cols]
+
+    def transform(self, X: Any) -> np.ndarray:
+        """
+        Run the compiled preprocessing.
+
+        Returns
+        -------
+        np.ndarray
+            float64 matrix with columns output_names.
+        """
+        cols, done = self._columns(X)  #done: True once column is float64
+
+        for op in self.ops:
+            kind = op[0]
+            if kind == 'map':
+                _, j, keys, values, unseen_nan = op
+                cols[j] = _lookup(cols[j], keys, values, unseen_nan)
+                done[j] = True
+                continue
+            if kind == 'select':
+                cols = [cols[j] for j in op[1]]
+                done = [done[j] for j in op[1]]
+                continue
+            if kind == 'knn':
+                _, fit_X, n_neighbors, weights, col_means = op
+                M = _knn_impute(_stack(cols, done), fit_X, n_neighbors, weights, col_means)
+                cols = [M[:, j] for j in range(M.shape[1])]
+                done = [True] * len(cols)
+                continue
+
+            j = op[1]
+            if not done[j]:
+                cols[j] = _as_float(cols[j])
+                done[j] = True
+            if kind == 'clip':
+                cols[j] = np.minimum(np.maximum(cols[j], op[2]), op[3])  #np.clip's wrapper costs more than the work on small batches
+            elif kind == 'scale':
+                cols[j] = (cols[j] - op[2]) / op[3]
+
+        return _stack(cols, done)
+
+    def predict_proba(self, X: Any) -> np.ndarray:
+        """
+        Positive-class probability for each row.
+
+        Returns
+        -------
+        np.ndarray
+            1-D array of probabilities.
+        """
+        assert self.model is not None, f'{self.__class__.__name__}.predict_proba needs a model; export_for_serving was called without one'
+        M = self.transform(X)
+        kind = self.model[0]
+        if kind == 'linear':
+            _, coef, intercept = self.model
+            return 1.0 / (1.0 + np.exp(-(M @ coef + intercept)))
+        if kind == 'knn':
+            _, fit_X, y, classes, n_neighbors, weights = self.model
+            d = np.sqrt(np.maximum((M * M).sum(axis=1)[:, None] - 2 * M @ fit_X.T + (fit_X * fit_X).sum(axis=1)[None, :], 0))
+            nearest = np.argpartition(d, n_neighbors - 1, axis=1)[:, :n_neighbors]
+            w = _neighbour_weights(np.take_along_axis(d, nearest, axis=1), weights)
+            return (w * (y[nearest] == classes[-1])).sum(axis=1) / w.sum(axis=1)
+        return self.model[1].predict_proba(M)[:, 1]
+
+    def predict(self, X: Any, threshold: Optional[float] = None) -> np.ndarray:
+        """0/1 labels using threshold (defaults to self.threshold)."""
+        t = self.threshold if threshold is None else threshold
+        return (self.predict_proba(X) >= t).astype(np.int8)
+
+    def save(self, path: str) -> None:
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path: str) -> 'ServingPipeline':
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+############ Decision policy. ###########
+class DecisionPolicy:
+    """
+    Operating points of a binary model, picked from a cached threshold lookup table.
+
+    Built by library.decision_policy from the cumulative counts of a validation set
+    (library.threshold_counts). The table keeps, for each candidate threshold (ascending),
+    the validation positives tp and negatives fp scored at or above it, so choosing an
+    operating point, or re-choosing it under another objective, is a scan of the table and
+    never rescores the validation set. At serve time the decision is one vectorized
+    comparison against the selected threshold.
+
+    Objectives:
+
+    - 'f1': the threshold with the highest F1 (ties go to the lowest threshold, as best_threshold)
+    - 'precision_floor': the highest recall whose precision is at least precision_floor
+    - 'recall_floor': the highest precision whose recall is at least recall_floor
+
+    Parameters
+    ----------
+    thresholds : array-like
+        Candidate thresholds, ascending.
+    tp, fp : array-like
+        Positives and negatives with a score >= each threshold.
+    n, n_pos : int
+        Validation rows and positives among them.
+    objective : str, default='f1'
+        Objective whose threshold is applied by decide.
+    precision_floor, recall_floor : float, optional
+        Floors of the 'precision_floor' and 'recall_floor' objectives; an objective without
+        its floor is not selected.
+    auc : float, optional
+        Validation AUC, kept for reference.
+
+    Raises
+    ------
+    ValueError
+        If no candidate threshold meets a given floor.
+    """
+
+    OBJECTIVES = ('f1', 'precision_floor', 'recall_floor')
+
+    def __init__(self, thresholds: Any, tp: Any, fp: Any, n: int, n_pos: int, objective: str = 'f1',
+                 precision_floor: Optional[float] = None, recall_floor: Optional[float] = None,
+                 auc: Optional[float] = None) -> None:
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        self.tp = np.asarray(tp, dtype=np.int64)
+        self.fp = np.asarray(fp, dtype=np.int64)
+        assert len(self.thresholds) == len(self.tp) == len(self.fp) > 0, f'{self.__class__.__name__} thresholds, tp and fp must be non-empty and the same length.'
+        assert np.all(np.diff(self.thresholds) > 0), f'{self.__class__.__name__} thresholds must be strictly ascending.'
+        assert objective in self.OBJECTIVES, f'{self.__class__.__name__} objective must be one of {self.OBJECTIVES} but got {objective} instead.'
+        self.n = int(n)
+        self.n_pos = int(n_pos)
+        self.objective = objective
+        self.precision_floor = precision_floor
+        self.recall_floor = recall_floor
+        self.auc = auc
+
+        self.selected: Dict[str, float] = {'f1': self._pick('f1')}
+        if precision_floor is not None:
+            self.selected['precision_floor'] = self._pick('precision_floor', precision_floor)
+        if recall_floor is not None:
+            self.selected['recall_floor'] = self._pick('recall_floor', recall_floor)
+        assert objective in self.selected, f'{self.__class__.__name__} objective {objective} needs its floor to be given.'
+        self.threshold = self.selected[objective]
+
+    def metrics(self) -> Dict[str, np.ndarray]:
+        """Precision, recall, f1 and accuracy at every candidate threshold (unrounded, zero_division=0)."""
+        tp, fp = self.tp, self.fp
+        fn = self.n_pos - tp
+        tn = (self.n - self.n_pos) - fp
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = np.where(tp + fp > 0, tp / (tp + fp), 0.0)
+            recall = tp / self.n_pos if self.n_pos > 0 else np.zeros(len(tp))
+            f1 = np.where(2 * tp + fp + fn > 0, 2 * tp / (2 * tp + fp + fn), 0.0)
+        return {'threshold': self.thresholds, 'precision': precision, 'recall': recall, 'f1': f1,
+                'accuracy': (tp + tn) / self.n}
+
+    def _pick(self, objective: str, floor: Optional[float] = None) -> float:
+        """Selected threshold of one objective: a lexicographic argmax over the table."""
+        m = self.metrics()
+        if objective == 'f1':
+            keys, feasible = (m['f1'],), np.ones(len(self.thresholds), dtype=bool)
+        elif objective == 'precision_floor':
+            keys, feasible = (m['recall'], m['precision']), m['precision'] >= floor
+        else:
+            keys, feasible = (m['precision'], m['recall']), m['recall'] >= floor
+        if not feasible.any():
+            raise ValueError(f'{self.__class__.__name__} no threshold reaches {objective.split("_")[0]} >= {floor}.')
+        best = np.flatnonzero(feasible)
+        for key in keys:
+            best = best[key[best] == key[best].max()]
+        return float(self.thresholds[best[0]])
+
+    def repick(self, objective: Optional[str] = None, precision_floor: Optional[float] = None,
+               recall_floor: Optional[float] = None) -> 'DecisionPolicy':
+        """
+        A policy with another objective or floors over the same table; arguments left as None
+        keep their current value. The validation set is not rescored.
+        """
+        return DecisionPolicy(self.thresholds, self.tp, self.fp, self.n, self.n_pos,
+                              objective=self.objective if objective is None else objective,
+                              precision_floor=self.precision_floor if precision_floor is None else precision_floor,
+                              recall_floor=self.recall_floor if recall_floor is None else recall_floor,
+                              auc=self.auc)
+
+    def decide(self, proba: Any) -> np.ndarray:
+        """0/1 labels: probability >= the selected threshold."""
+        return (np.asarray(proba) >= self.threshold).astype(np.int8)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'objective': self.objective, 'threshold': self.threshold, 'selected': self.selected,
+                'precision_floor': self.precision_floor, 'recall_floor': self.recall_floor,
+                'n': self.n, 'n_pos': self.n_pos, 'auc': self.auc,
+                'table': {'thresholds': self.thresholds.tolist(), 'tp': self.tp.tolist(), 'fp': self.fp.tolist()}}
+
+    def save(self, path: str) -> None:
+        """Saves the policy as JSON, e.g. final_logreg_policy.json next to final_logreg_model.joblib."""
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    @staticmethod
+    def load(path: str) -> 'DecisionPolicy':
+        with open(path) as f:
+            state = json.load(f)
+        table = state['table']
+        return DecisionPolicy(table['thresholds'], table['tp'], table['fp'], state['n'], state['n_pos'],
+                              objective=state['objective'], precision_floor=state['precision_floor'],
+                              recall_floor=state['recall_floor'], auc=state['auc'])
+
+
+############ Artifact registry. ###########
+_LOADED: Dict[Tuple[str, Optional[str]], Tuple[int, Any]] = {}  #(path, mmap_mode) -> (mtime, artifact), shared by the whole process
+_LOAD_LOCKS: Dict[Tuple[str, Optional[str]], threading.Lock] = {}  #one per key, so slow loads of different files overlap
+_LOAD_LOCK = threading.Lock()  #guards _LOAD_LOCKS only
+
+
+def load_artifact(path: str, mmap_mode: Optional[str] = 'r') -> Any:
+    """
+    Loads an artifact once per process; later calls (from any thread) get the same object
+    until the file changes. The version loaded before a change is then dropped from the
+    registry, so a redeployed file does not keep its old versions alive.
+
+    .keras files are loaded with keras and .json files as a DecisionPolicy. Anything else goes
+    through joblib with mmap_mode, so the NumPy arrays of uncompressed joblib files are
+    memory-mapped (read-only) rather than read; plain pickles load as usual. Pickles of the custom transformers made in a notebook
+    (classes in __main__) are handed to library.load_artifact, which is only imported then.
+    """
+    path = os.path.abspath(path)
+    key, mtime = (path, mmap_mode), os.stat(path).st_mtime_ns
+    with _LOAD_LOCK:
+        lock = _LOAD_LOCKS.setdefault(key, threading.Lock())
+    with lock:
+        if key not in _LOADED or _LOADED[key][0] != mtime:
+            _LOADED[key] = (mtime, _load_file(path, mmap_mode))
+        return _LOADED[key][1]
+
+
+def _load_file(path: str, mmap_mode: Optional[str]) -> Any:
+    if path.endswith('.json'):
+        return DecisionPolicy.load(path)
+    if path.endswith('.keras'):
+        import keras
+        return keras.models.load_model(path)
+    import joblib
+    try:
+        return joblib.load(path, mmap_mode=mmap_mode)
+    except AttributeError as e:
+        if '__main__' not in str(e):
+            raise
+        import library
+        return library.load_artifact(path, mmap_mode=mmap_mode)
+
+
+class ArtifactRegistry:
+    """
+    Artifacts by name, loaded lazily on first use and cached per process.
+
+    Names are registered explicitly or found in directory: name 'final_knn_model' resolves
+    to the first of final_knn_model.joblib, .pkl, .keras, .serving or .json (a DecisionPolicy)
+    that exists. Nothing is read (and no model library imported) until an artifact is first
+    asked for, so a worker that only serves one model never pays for the others.
+
+    Parameters
+    ----------
+    directory : str, default='.'
+        Where unregistered names are looked up.
+    mmap_mode : str, optional, default='r'
+        Passed to joblib.load; None reads arrays into memory (needed to modify them).
+    paths : Dict[str, str], optional
+        Explicit name -> path entries.
+
+    Examples
+    --------
+    >>> registry = ArtifactRegistry('.')
+    >>> model = registry['final_knn_model']        # loaded now, memory-mapped
+    >>> registry.get('final_knn_model') is model    # cached
+    True
+    """
+
+    EXTENSIONS = ('.joblib', '.pkl', '.keras', '.serving', '.json')
+
+    def __init__(self, directory: str = '.', mmap_mode: Optional[str] = 'r', paths: Optional[Dict[str, str]] = None) -> None:
+        self.directory = directory
+        self.mmap_mode = mmap_mode
+        self.paths: Dict[str, str] = dict(paths or {})
+
+    def register(self, name: str, path: str) -> 'ArtifactRegistry':
+        self.paths[name] = path
+        return self
+
+    def path(self, name: str) -> str:
+        if name in self.paths:
+            return self.paths[name]
+        candidates = [os.path.join(self.directory, name)] + [os.path.join(self.directory, name + ext) for ext in self.EXTENSIONS]
+        for candidate in candidates:
+            if os.path.isfile(candidate):
+                return candidate
+        raise KeyError(f'{self.__class__.__name__} has no artifact {name!r} (registered: {sorted(self.paths)}, directory: {self.directory})')
+
+    def names(self) -> List[str]:
+        """Registered names plus every artifact file in directory, without extension."""
+        found = {os.path.splitext(f)[0] for f in os.listdir(self.directory) if f.endswith(self.EXTENSIONS)}
+        return sorted(found | set(self.paths))
+
+    def get(self, name: str) -> Any:
+        return load_artifact(self.path(name), self.mmap_mode)
+
+    __getitem__ = get
+
+    def __contains__(self, name: str) -> bool:
+        try:
+            self.path(name)
+            return True
+        except KeyError:
+            return False
+
+    def preload(self, *names: str) -> 'ArtifactRegistry':
+        """Loads names now (e.g. in a worker initializer) so the first request doesn't wait."""
+        for name in names:
+            self.get(name)
+        return self